@@ -1,10 +1,122 @@
-import requests
-from datetime import datetime, timedelta
-import pytz
+from datetime import datetime, timedelta, tzinfo
+from calendars.leadconnector.client import SESSION, get_zone
+from ciso8601 import parse_datetime
 import azure.functions as func
-import json
+import orjson
 import logging
 import re
+import time
+
+
+# calendar_id -> (time.monotonic() when detected, calendar tzinfo)
+_TZ_CACHE: dict[str, tuple[float, tzinfo]] = {}
+_TZ_CACHE_TTL = 3600
+
+# Appointment booking request pieces that never change between calls
+_BOOK_URL = "https://services.leadconnectorhq.com/calendars/events/appointments"
+_BOOK_STATIC_HEADERS = {
+    "Content-Type": "application/json",
+    "version": "2021-04-15",
+}
+# Per-call keys are None here and filled in with | so the key order is kept
+_BOOK_PAYLOAD_TEMPLATE = {
+    "title": None,
+    "calendarId": None,
+    "locationId": None,
+    "contactId": None,
+    "startTime": None,
+    "endTime": None,
+    "meetingLocationType": "custom",
+    "meetingLocationId": "custom_0",
+    "overrideLocationConfig": True,
+    "appointmentStatus": "confirmed",
+    "description": None,
+    "ignoreDateRange": False,
+    "toNotify": True,
+    "ignoreFreeSlotValidation": False,
+}
+
+
+# Precompiled patterns for parse_human_datetime
+# One pass over the string handles every normalization branch:
+#   ordinals          "28th"                               -> "28"
+#   times with AM/PM  "11AM" / "11 30 AM" / "08:30:00 AM"  -> "11:00 AM" / "11:30 AM" / "08:30 AM"
+#   bare seconds      "14:30:00"                           -> "14:30"
+_NORMALIZE = re.compile(
+    r"(\d+)(?:st|nd|rd|th)"
+    r"|\b(\d{1,2})(?::(\d{2})(?::\d{2})?| (\d{2}))? ?(AM|PM)\b"
+    r"|\b(\d{1,2}:\d{2}):\d{2}\b",
+    re.IGNORECASE,
+)
+
+
+def _normalize_repl(m):
+    ordinal, hour, minute, spaced_minute, ampm, hh_mm = m.groups()
+    if ordinal is not None:
+        return ordinal
+    if ampm is not None:
+        return f"{hour}:{minute or spaced_minute or '00'} {ampm.upper()}"
+    return hh_mm
+
+
+# "[Weekday] Month Day Year [at] HH:MM AM/PM" once normalized
+_DT_REGEX = re.compile(
+    r"(?:(\w+)\s+)?(\w+)\s+(\d{1,2})\s+(\d{4})(?:\s+at)?\s+(\d{1,2}):(\d{2})\s*(AM|PM)",
+    re.IGNORECASE,
+)
+
+_MONTHS = {
+    "jan": 1, "january": 1,
+    "feb": 2, "february": 2,
+    "mar": 3, "march": 3,
+    "apr": 4, "april": 4,
+    "may": 5,
+    "jun": 6, "june": 6,
+    "jul": 7, "july": 7,
+    "aug": 8, "august": 8,
+    "sep": 9, "september": 9,
+    "oct": 10, "october": 10,
+    "nov": 11, "november": 11,
+    "dec": 12, "december": 12,
+}
+
+_WEEKDAYS = frozenset(
+    ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+)
+
+# TIMEZONE MAPPING
+_FULL_TZ_MAP = {
+    "PACIFIC STANDARD TIME": "America/Los_Angeles",
+    "PACIFIC DAYLIGHT TIME": "America/Los_Angeles",
+    "MOUNTAIN STANDARD TIME": "America/Denver",
+    "MOUNTAIN DAYLIGHT TIME": "America/Denver",
+    "CENTRAL STANDARD TIME": "America/Chicago",
+    "CENTRAL DAYLIGHT TIME": "America/Chicago",
+    "EASTERN STANDARD TIME": "America/New_York",
+    "EASTERN DAYLIGHT TIME": "America/New_York",
+}
+
+_ABBREV_TZ_MAP = {
+    "PST": "America/Los_Angeles",
+    "PDT": "America/Los_Angeles",
+    "MST": "America/Denver",
+    "MDT": "America/Denver",
+    "CST": "America/Chicago",
+    "CDT": "America/Chicago",
+    "EST": "America/New_York",
+    "EDT": "America/New_York",
+}
+
+# Upper-cased timezone text -> IANA name, one lookup for both spellings
+_TZ_LOOKUP = {k.upper(): v for k, v in _FULL_TZ_MAP.items()} | _ABBREV_TZ_MAP
+
+# Timezone must be at the end of the string
+_TZ_REGEX = re.compile(
+    r"(Pacific Standard Time|Pacific Daylight Time|Mountain Standard Time|"
+    r"Mountain Daylight Time|Central Standard Time|Central Daylight Time|"
+    r"Eastern Standard Time|Eastern Daylight Time|PST|PDT|MST|MDT|CST|CDT|EST|EDT)$",
+    re.IGNORECASE,
+)
 
 
 def parse_human_datetime(dt_str: str):
@@ -22,142 +134,98 @@ def parse_human_datetime(dt_str: str):
     - times with seconds ("08:30:00 AM")
     """
 
-    from datetime import datetime
-    import pytz
-
     original = dt_str
 
-    # 1) Normalize whitespace
-    s = re.sub(r"\s+", " ", dt_str).strip()
-
-    # 2) Remove ordinal suffixes ("st", "nd", "rd", "th") -> "28th" -> "28"
-    s = re.sub(r"(\d+)(st|nd|rd|th)", r"\1", s, flags=re.IGNORECASE)
-
-    # 3) Remove commas
-    s = s.replace(",", "")
-
-    # 4) Fix missing space before AM/PM ("11AM" → "11 AM")
-    s = re.sub(r"(\d)(AM|PM)\b", r"\1 \2", s, flags=re.IGNORECASE)
-
-    # 5) Fix missing colon ("11 30 AM" → "11:30 AM")
-    s = re.sub(r"\b(\d{1,2}) (\d{2}) (AM|PM)\b", r"\1:\2 \3", s, flags=re.IGNORECASE)
-
-    # 6) Fix hour-only times ("11 AM" → "11:00 AM")
-    s = re.sub(r"\b(\d{1,2}) (AM|PM)\b", r"\1:00 \2", s, flags=re.IGNORECASE)
-
-    # 7) Strip seconds if present ("08:30:00 AM" → "08:30 AM")
-    s = re.sub(r"\b(\d{1,2}:\d{2}):\d{2}\b", r"\1", s)
-
-    # 8) Insert "at" if missing between year and time ("2025 08:30 AM" → "2025 at 08:30 AM")
-    s = re.sub(
-        r"(\d{4}) (\d{1,2}:\d{2} (AM|PM))",
-        r"\1 at \2",
-        s,
-        flags=re.IGNORECASE,
-    )
+    # Collapse whitespace and drop commas, then fix ordinals and time
+    # shapes in a single regex pass
+    s = " ".join(dt_str.split()).replace(",", "")
+    s = _NORMALIZE.sub(_normalize_repl, s)
 
     logging.info(f"[PARSE] Normalized datetime: {s}")
 
-    # TIMEZONE MAPPING
-    full_tz_map = {
-        "PACIFIC STANDARD TIME": "America/Los_Angeles",
-        "PACIFIC DAYLIGHT TIME": "America/Los_Angeles",
-        "MOUNTAIN STANDARD TIME": "America/Denver",
-        "MOUNTAIN DAYLIGHT TIME": "America/Denver",
-        "CENTRAL STANDARD TIME": "America/Chicago",
-        "CENTRAL DAYLIGHT TIME": "America/Chicago",
-        "EASTERN STANDARD TIME": "America/New_York",
-        "EASTERN DAYLIGHT TIME": "America/New_York",
-    }
-
-    abbrev_map = {
-        "PST": "America/Los_Angeles",
-        "PDT": "America/Los_Angeles",
-        "MST": "America/Denver",
-        "MDT": "America/Denver",
-        "CST": "America/Chicago",
-        "CDT": "America/Chicago",
-        "EST": "America/New_York",
-        "EDT": "America/New_York",
-    }
-
-    # Extract timezone (must be at the end)
-    tz_regex = (
-        r"(Pacific Standard Time|Pacific Daylight Time|Mountain Standard Time|"
-        r"Mountain Daylight Time|Central Standard Time|Central Daylight Time|"
-        r"Eastern Standard Time|Eastern Daylight Time|PST|PDT|MST|MDT|CST|CDT|EST|EDT)$"
-    )
-
-    tz_match = re.search(tz_regex, s, re.IGNORECASE)
+    tz_match = _TZ_REGEX.search(s)
     if not tz_match:
         raise ValueError(f"[ERROR] Could not extract timezone from: {original}")
 
     tz_raw = tz_match.group(0).upper()
 
-    if tz_raw in full_tz_map:
-        tz_name = full_tz_map[tz_raw]
-    else:
-        tz_name = abbrev_map.get(tz_raw)
-
-    if not tz_name:
+    tz_name = _TZ_LOOKUP.get(tz_raw)
+    if tz_name is None:
         raise ValueError(f"[ERROR] Unknown timezone: {tz_raw}")
 
     # Strip timezone for datetime parsing
-    s_no_tz = re.sub(tz_regex, "", s, flags=re.IGNORECASE).strip()
+    s_no_tz = s[:tz_match.start()].rstrip()
     logging.info(f"[PARSE] Datetime without timezone: {s_no_tz}")
 
-    # Try multiple formats (weekday + full month + day + year + time)
-    fmts = [
-        "%A %B %d %Y at %I:%M %p",
-        "%A %b %d %Y at %I:%M %p",
-        "%B %d %Y at %I:%M %p",
-        "%b %d %Y at %I:%M %p",
-        "%A %B %d %Y %I:%M %p",
-        "%A %b %d %Y %I:%M %p",
-        "%B %d %Y %I:%M %p",
-        "%b %d %Y %I:%M %p",
-    ]
-
+    # Match weekday? + month + day + year + time and build the datetime directly
     naive = None
-    for fmt in fmts:
-        try:
-            naive = datetime.strptime(s_no_tz, fmt)
-            break
-        except Exception:
-            continue
+    m = _DT_REGEX.fullmatch(s_no_tz)
+    if m:
+        weekday, month, day, year, hour, minute, ampm = m.groups()
+        month_num = _MONTHS.get(month.lower())
+        hour = int(hour)
+        if (
+            month_num
+            and 1 <= hour <= 12
+            and (weekday is None or weekday.lower() in _WEEKDAYS)
+        ):
+            try:
+                naive = datetime(
+                    int(year),
+                    month_num,
+                    int(day),
+                    hour % 12 + (12 if ampm.upper() == "PM" else 0),
+                    int(minute),
+                )
+            except ValueError:
+                pass
 
     if naive is None:
         raise ValueError(
             f"[ERROR] Invalid datetime after normalization: '{s_no_tz}'\nOriginal: '{original}'"
         )
 
-    tz = pytz.timezone(tz_name)
-    return tz.localize(naive)
+    return naive.replace(tzinfo=get_zone(tz_name))
 
 
 def detect_calendar_timezone(calendar_id, token):
+    """
+    Returns the calendar's timezone, re-detecting it at most once an hour
+    per calendar.
+    """
+    cached = _TZ_CACHE.get(calendar_id)
+    if cached and time.monotonic() - cached[0] < _TZ_CACHE_TTL:
+        return cached[1]
+
+    tz = _fetch_calendar_timezone(calendar_id, token)
+    _TZ_CACHE[calendar_id] = (time.monotonic(), tz)
+    return tz
+
+
+def _fetch_calendar_timezone(calendar_id, token):
     """
     Makes a free-slots API call and returns the timezone from one slot.
     """
-    now = datetime.now(pytz.utc)
-    start_ms = int(now.timestamp() * 1000)
-    end_ms = int((now + timedelta(days=7)).timestamp() * 1000)
+    start_ms = time.time_ns() // 1_000_000
+    end_ms = start_ms + 7 * 86_400_000
 
     url = f"https://services.leadconnectorhq.com/calendars/{calendar_id}/free-slots"
     headers = {"Authorization": f"Bearer {token}"}
     params = {"startDate": start_ms, "endDate": end_ms}
 
-    res = requests.get(url, headers=headers, params=params)
+    res = SESSION.get(url, headers=headers, params=params)
     if res.status_code != 200:
         raise Exception(f"[ERROR] Cannot detect calendar timezone: {res.text}")
 
-    data = res.json()
-    for _, obj in data.items():
-        if isinstance(obj, dict) and "slots" in obj and obj["slots"]:
-            dt = datetime.fromisoformat(obj["slots"][0])
-            return dt.tzinfo
+    data = orjson.loads(res.content)
+    day = next(
+        (obj for obj in data.values() if isinstance(obj, dict) and obj.get("slots")),
+        None,
+    )
+    if day is None:
+        raise Exception("[ERROR] Calendar returned no slots to detect timezone")
 
-    raise Exception("[ERROR] Calendar returned no slots to detect timezone")
+    return parse_datetime(day["slots"][0]).tzinfo
 
 
 def book_leadconnector_appointment(req: func.HttpRequest) -> func.HttpResponse:
@@ -209,39 +277,27 @@ def book_leadconnector_appointment(req: func.HttpRequest) -> func.HttpResponse:
     end_iso = (calendar_dt + timedelta(minutes=30)).isoformat()
 
     # Build API payload
-    payload = {
+    payload = _BOOK_PAYLOAD_TEMPLATE | {
         "title": f"AI Scheduled Call - {lead_name}",
         "calendarId": calendar_id,
         "locationId": location_id,
         "contactId": contact_id,
         "startTime": start_iso,
         "endTime": end_iso,
-        "meetingLocationType": "custom",
-        "meetingLocationId": "custom_0",
-        "overrideLocationConfig": True,
-        "appointmentStatus": "confirmed",
         "description": description,
-        "ignoreDateRange": False,
-        "toNotify": True,
-        "ignoreFreeSlotValidation": False,
     }
 
-    url = "https://services.leadconnectorhq.com/calendars/events/appointments"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-        "version": "2021-04-15",
-    }
+    headers = {**_BOOK_STATIC_HEADERS, "Authorization": f"Bearer {token}"}
 
-    res = requests.post(url, headers=headers, json=payload)
+    res = SESSION.post(_BOOK_URL, headers=headers, data=orjson.dumps(payload))
 
     return func.HttpResponse(
-        json.dumps(
+        orjson.dumps(
             {
                 "response": res.text,
                 "payload": payload,
             },
-            indent=2,
+            option=orjson.OPT_INDENT_2,
         ),
         mimetype="application/json",
         status_code=res.status_code,
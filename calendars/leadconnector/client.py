@@ -0,0 +1,41 @@
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+from utils.state_timezones import STATE_TIMEZONES
+
+
+# Shared keep-alive connection pool for LeadConnector calls
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=50))
+SESSION.headers.update({"Accept-Encoding": "gzip"})
+
+
+@lru_cache(maxsize=64)
+def get_zone(name):
+    return ZoneInfo(name)
+
+
+def _preconnect():
+    try:
+        SESSION.head("https://services.leadconnectorhq.com", timeout=5)
+    except requests.RequestException:
+        logging.info("[WARMUP] LeadConnector pre-connect failed", exc_info=True)
+
+
+def _warmup():
+    """
+    Runs at import so a cold start pays for zone loading and the first TLS
+    handshake before the first request instead of during it.
+    """
+    get_zone("UTC")
+    for name in set(STATE_TIMEZONES.values()):
+        get_zone(name)
+
+    # Open a pooled connection in the background; never block import on it
+    threading.Thread(target=_preconnect, daemon=True).start()
+
+
+_warmup()
@@ -1,9 +1,27 @@
-import requests
+from bisect import bisect_right
+import heapq
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, time
-import pytz
+from functools import lru_cache
+from itertools import chain
+from time import time_ns
 from utils.state_timezones import get_timezone_for_state
+from calendars.leadconnector.client import SESSION, get_zone
+from ciso8601 import parse_datetime
 import azure.functions as func
-import json
+import orjson
+
+
+# How many slots closest to requested_date_time are returned
+_MAX_NEAREST_TIMES = 20
+
+# Worker threads for issuing independent LeadConnector calls concurrently
+_EXECUTOR = ThreadPoolExecutor(max_workers=32, thread_name_prefix="leadconnector")
+
+
+@lru_cache(maxsize=64)
+def _state_tz(state_code):
+    return get_zone(get_timezone_for_state(state_code))
 
 
 # --------------------------------------------------
@@ -18,6 +36,22 @@ def log_dep(url, payload, status_code, response_json):
     }
 
 
+def _get_json(url, headers, params=None):
+    """
+    GET a LeadConnector URL and return (status_code, json). The JSON is {}
+    when the body can't be decoded.
+    """
+    res = SESSION.get(url, headers=headers, params=params)
+
+    try_json = {}
+    try:
+        try_json = orjson.loads(res.content)
+    except Exception:
+        pass
+
+    return res.status_code, try_json
+
+
 def _is_offset_like_tz(tz_str: str) -> bool:
     """
     Treat pure offset-style strings (e.g. '-03', '+02') as invalid
@@ -33,53 +67,45 @@ def _is_offset_like_tz(tz_str: str) -> bool:
 # Resolve customer timezone using API calls
 # --------------------------------------------------
 def resolve_customer_timezone(contact_id, location_id, state_code, auth_token, dep_logs):
-    base_headers = {"Authorization": f"Bearer {auth_token}"}
+    bearer = f"Bearer {auth_token}"
+    contact_headers = {"Authorization": bearer, "version": "2021-04-15"}
+    location_headers = {"Authorization": bearer, "version": "2021-07-28"}
 
-    # 1️⃣ Contact timezone (customer)
+    # Fire the contact and location calls together; neither depends on the other
+    contact_future = None
     if contact_id:
         contact_url = f"https://services.leadconnectorhq.com/contacts/{contact_id}"
-        headers = base_headers.copy()
-        headers["version"] = "2021-04-15"
+        contact_future = _EXECUTOR.submit(_get_json, contact_url, contact_headers)
 
-        res = requests.get(contact_url, headers=headers)
+    loc_future = None
+    if location_id:
+        loc_url = f"https://services.leadconnectorhq.com/locations/{location_id}"
+        loc_future = _EXECUTOR.submit(_get_json, loc_url, location_headers)
 
-        try_json = {}
-        try:
-            try_json = res.json()
-        except Exception:
-            pass
+    customer_tz = None
 
-        dep_logs.append(log_dep(contact_url, {}, res.status_code, try_json))
+    # 1️⃣ Contact timezone (customer)
+    if contact_future:
+        status_code, try_json = contact_future.result()
+        dep_logs.append(log_dep(contact_url, {}, status_code, try_json))
 
-        if res.status_code == 200:
+        if status_code == 200:
             tz = try_json.get("contact", {}).get("timezone")
             if tz and not _is_offset_like_tz(tz):
                 try:
-                    return pytz.timezone(tz)
+                    customer_tz = get_zone(tz)
                 except Exception:
                     # fall through to state
                     pass
 
     # 2️⃣ Location call ONLY for logging (do NOT use its timezone for customer)
-    if location_id:
-        loc_url = f"https://services.leadconnectorhq.com/locations/{location_id}"
-        headers = base_headers.copy()
-        headers["version"] = "2021-07-28"
-
-        res = requests.get(loc_url, headers=headers)
-
-        try_json = {}
-        try:
-            try_json = res.json()
-        except Exception:
-            pass
-
-        dep_logs.append(log_dep(loc_url, {}, res.status_code, try_json))
+    if loc_future:
+        status_code, try_json = loc_future.result()
+        dep_logs.append(log_dep(loc_url, {}, status_code, try_json))
         # intentionally NOT using location.timezone as customer timezone
 
     # 3️⃣ State fallback (customer timezone)
-    return pytz.timezone(get_timezone_for_state(state_code))
-
+    return customer_tz or _state_tz(state_code)
 
 
 def format_datetime(dt):
@@ -99,7 +125,7 @@ def format_datetime(dt):
 def parse_requested_datetime(dt_str, customer_tz):
     try:
         naive = datetime.strptime(dt_str, "%Y-%m-%d %I:%M %p")
-        return customer_tz.localize(naive)
+        return naive.replace(tzinfo=customer_tz)
     except Exception:
         raise ValueError("requested_date_time must be in format YYYY-MM-DD HH:MM AM/PM")
 
@@ -108,6 +134,44 @@ def is_in_business_hours(dt):
     return time(8, 0) <= dt.time() <= time(17, 0)
 
 
+def _business_hours_windows(first, last, tz):
+    """
+    Business-hours bounds as UTC epoch seconds for every local day in tz
+    from first to last, returned as parallel (opens, closes) lists.
+    """
+    day = first.astimezone(tz).date()
+    end = last.astimezone(tz).date()
+    opens, closes = [], []
+    while day <= end:
+        opens.append(datetime.combine(day, time(8, 0), tzinfo=tz).timestamp())
+        closes.append(datetime.combine(day, time(17, 0), tzinfo=tz).timestamp())
+        day += timedelta(days=1)
+    return opens, closes
+
+
+def filter_business_hours(slots, customer_tz):
+    """
+    Returns the slots that fall inside the customer's business hours,
+    converted to customer_tz. Slots are first checked against per-day epoch
+    windows so only the survivors pay for astimezone();
+    is_in_business_hours still has the final say.
+    """
+    if not slots:
+        return []
+
+    opens, closes = _business_hours_windows(min(slots), max(slots), customer_tz)
+
+    times_customer = []
+    for slot in slots:
+        ts = slot.timestamp()
+        i = bisect_right(opens, ts) - 1
+        if i < 0 or ts > closes[i]:
+            continue
+        dt = slot.astimezone(customer_tz)
+        if is_in_business_hours(dt):
+            times_customer.append(dt)
+    return times_customer
+
 
 def handle_leadconnector_request(req):
     orgid = req.params.get("orgid")
@@ -131,36 +195,34 @@ def handle_leadconnector_request(req):
     dep_logs = []
 
     # --------------------------------------------------
-    # Resolve customer timezone (CONTACT → STATE; location only logged)
-    # --------------------------------------------------
-    customer_tz = resolve_customer_timezone(
-        contact_id, location_id, state_code, auth_token, dep_logs
-    )
-
-    # --------------------------------------------------
-    # Fetch free slots from LeadConnector
+    # Fetch free slots from LeadConnector (in flight while the
+    # customer timezone lookups below run)
     # --------------------------------------------------
-    now_utc = datetime.now(pytz.utc)
-    start_ms = int(now_utc.timestamp() * 1000)
-    end_ms = int((now_utc + timedelta(days=7)).timestamp() * 1000)
+    start_ms = time_ns() // 1_000_000
+    end_ms = start_ms + 7 * 86_400_000
 
     slot_url = f"https://services.leadconnectorhq.com/calendars/{calendar_id}/free-slots"
     slot_headers = {"Authorization": f"Bearer {auth_token}"}
     slot_params = {"startDate": start_ms, "endDate": end_ms}
 
-    slot_res = requests.get(slot_url, headers=slot_headers, params=slot_params)
+    slot_future = _EXECUTOR.submit(_get_json, slot_url, slot_headers, slot_params)
 
-    slot_json = {}
-    try:
-        slot_json = slot_res.json()
-    except Exception:
-        pass
+    # --------------------------------------------------
+    # Resolve customer timezone (CONTACT → STATE; location only logged)
+    # --------------------------------------------------
+    customer_tz = resolve_customer_timezone(
+        contact_id, location_id, state_code, auth_token, dep_logs
+    )
+
+    # The whole free-slots body is echoed back in dependent_requests, so it
+    # is decoded in one go rather than stream-parsed with an early exit.
+    slot_status, slot_json = slot_future.result()
 
-    dep_logs.append(log_dep(slot_url, slot_params, slot_res.status_code, slot_json))
+    dep_logs.append(log_dep(slot_url, slot_params, slot_status, slot_json))
 
-    if slot_res.status_code != 200:
+    if slot_status != 200:
         return func.HttpResponse(
-            json.dumps({
+            orjson.dumps({
                 "available_times": {"array": [], "string": ""},
                 "dependent_requests": dep_logs
             }),
@@ -168,21 +230,22 @@ def handle_leadconnector_request(req):
             status_code=500
         )
 
-    data = slot_json
-
     # Flatten provider slots (these are in provider/calendar timezone, e.g. -03)
-    provider_slots = []
-    for _, obj in data.items():
-        if isinstance(obj, dict) and "slots" in obj:
-            for slot_str in obj["slots"]:
-                provider_slots.append(datetime.fromisoformat(slot_str))
+    provider_slots = [
+        parse_datetime(slot_str)
+        for slot_str in chain.from_iterable(
+            obj["slots"]
+            for obj in slot_json.values()
+            if isinstance(obj, dict) and obj.get("slots")
+        )
+    ]
 
     if not provider_slots:
         result = {
             "available_times": {"array": [], "string": ""},
             "dependent_requests": dep_logs
         }
-        return func.HttpResponse(json.dumps(result), mimetype="application/json")
+        return func.HttpResponse(orjson.dumps(result), mimetype="application/json")
 
     provider_tz = provider_slots[0].tzinfo  # e.g. -03 / America/Sao_Paulo
 
@@ -200,25 +263,22 @@ def handle_leadconnector_request(req):
 
         eligible_slots = [slot for slot in provider_slots if slot >= start_day_provider]
 
-        # convert provider slots -> customer timezone
-        times_customer = [
-            slot.astimezone(customer_tz) for slot in eligible_slots
-        ]
-
-        times_customer = [dt for dt in times_customer if is_in_business_hours(dt)]
+        # convert provider slots -> customer timezone (business hours only)
+        times_customer = filter_business_hours(eligible_slots, customer_tz)
 
-        times_customer = sorted(
+        requested_ts = requested_customer.timestamp()
+        times_customer = heapq.nsmallest(
+            _MAX_NEAREST_TIMES,
             times_customer,
-            key=lambda dt: abs(dt - requested_customer)
+            key=lambda dt: abs(dt.timestamp() - requested_ts)
         )
 
     else:
         now_provider = datetime.now(provider_tz)
         eligible_slots = [slot for slot in provider_slots if slot >= now_provider]
 
-        # convert provider slots -> customer timezone
-        times_customer = [slot.astimezone(customer_tz) for slot in eligible_slots]
-        times_customer = [dt for dt in times_customer if is_in_business_hours(dt)]
+        # convert provider slots -> customer timezone (business hours only)
+        times_customer = filter_business_hours(eligible_slots, customer_tz)
 
     # --------------------------------------------------
     # Format output
@@ -235,7 +295,7 @@ def handle_leadconnector_request(req):
     }
 
     return func.HttpResponse(
-        json.dumps(response_payload),
+        orjson.dumps(response_payload),
         mimetype="application/json",
         status_code=200
     )
@@ -1,8 +1,22 @@
+import logging
 import azure.functions as func
 from calendars.leadconnector.leadconnector import handle_leadconnector_request
 from calendars.leadconnector.book import book_leadconnector_appointment
-from voiceagents.twiml import handle_twiml
-from voiceagents.twiml import handle_input
+
+# The voice agent refuses to load without its Azure OpenAI app settings;
+# only its own routes are left out then, the calendar routes still load
+try:
+    from voiceagents.twiml import handle_twiml
+    from voiceagents.twiml import handle_input
+    from voiceagents.twiml import handle_continue
+    from voiceagents.twiml import handle_partial
+    from voiceagents.memory import purge_expired_history
+    from voiceagents.memory import CALL_MEMORY_CONNECTION_STRING
+except RuntimeError:
+    logging.exception("Voice agent routes disabled")
+    VOICE_AGENT_ENABLED = False
+else:
+    VOICE_AGENT_ENABLED = True
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
@@ -10,6 +24,13 @@ app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 # ------------------------
 # CALENDAR PROVIDER ROUTER
 # ------------------------
+# provider route segment -> request handler (more providers coming soon…,
+# e.g. "calendly": handle_calendly_request, "outlook": handle_outlook_request)
+_PROVIDERS = {
+    "leadconnector": handle_leadconnector_request,
+}
+
+
 @app.route(route="calendar/{provider}/get-available-times")
 def calendar_router(req: func.HttpRequest) -> func.HttpResponse:
     provider = req.route_params.get("provider")
@@ -17,16 +38,11 @@ def calendar_router(req: func.HttpRequest) -> func.HttpResponse:
     if not provider:
         return func.HttpResponse("Missing provider", status_code=400)
 
-    provider = provider.lower()
-
-    if provider == "leadconnector":
-        return handle_leadconnector_request(req)
+    provider = provider.casefold()
 
-    # more providers coming soon…
-    # elif provider == "calendly":
-    #     return handle_calendly_request(req)
-    # elif provider == "outlook":
-    #     return handle_outlook_request(req)
+    handler = _PROVIDERS.get(provider)
+    if handler:
+        return handler(req)
 
     return func.HttpResponse(
         f"Unknown provider '{provider}'",
@@ -42,11 +58,29 @@ def lc_book(req: func.HttpRequest):
 # ------------------------
 # VOICE AGENT ROUTES
 # ------------------------
-@app.route(route="voiceagents/twiml", methods=["GET", "POST"])
-def voiceagents_twiml(req: func.HttpRequest) -> func.HttpResponse:
-    # Delegate to the implementation in voiceagents.twiml
-    return handle_twiml(req)
-
-@app.route(route="voiceagents/handle-input", methods=["POST"])
-def voiceagents_handle_input(req: func.HttpRequest):
-    return handle_input(req)
+if VOICE_AGENT_ENABLED:
+    @app.route(route="voiceagents/twiml", methods=["GET", "POST"])
+    async def voiceagents_twiml(req: func.HttpRequest) -> func.HttpResponse:
+        # Delegate to the implementation in voiceagents.twiml
+        return handle_twiml(req)
+
+    @app.route(route="voiceagents/handle-input", methods=["POST"])
+    async def voiceagents_handle_input(req: func.HttpRequest):
+        return await handle_input(req)
+
+    @app.route(route="voiceagents/continue-reply", methods=["POST"])
+    async def voiceagents_continue_reply(req: func.HttpRequest):
+        return await handle_continue(req)
+
+    @app.route(route="voiceagents/partial", methods=["POST"])
+    async def voiceagents_partial(req: func.HttpRequest):
+        return await handle_partial(req)
+
+    # Call transcripts in Table Storage are deleted once past retention;
+    # without Table Storage there is nothing to purge, and no timer to wake
+    # an instance for
+    if CALL_MEMORY_CONNECTION_STRING:
+        @app.timer_trigger(schedule="0 */15 * * * *", arg_name="timer")
+        async def voiceagents_purge_call_memory(timer: func.TimerRequest) -> None:
+            deleted = await purge_expired_history()
+            logging.info("Purged %d expired call histories", deleted)
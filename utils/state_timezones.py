@@ -1,7 +1,4 @@
-
-
-def get_timezone_for_state(state_code: str) -> str:
-    STATE_TIMEZONES = {
+STATE_TIMEZONES = {
     "AL": "America/Chicago",
     "AK": "America/Anchorage",
     "AZ": "America/Phoenix",
@@ -55,4 +52,6 @@ def get_timezone_for_state(state_code: str) -> str:
     "WY": "America/Denver",
 }
 
-    return STATE_TIMEZONES.get(state_code.upper(), "America/New_York")
\ No newline at end of file
+
+def get_timezone_for_state(state_code: str) -> str:
+    return STATE_TIMEZONES.get(state_code.upper(), "America/New_York")
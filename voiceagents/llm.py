@@ -1,36 +1,282 @@
+import asyncio
 import os
-import requests
+import random
+import aiohttp
+import orjson
+from contextlib import asynccontextmanager
 
-AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
-AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
-AZURE_OPENAI_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT")
 
-def ask_llm(user_text: str, history: list):
+def _require_env(name: str) -> str:
+    # Fail at import so the host logs a misconfiguration right away instead
+    # of the first call timing out against a malformed URL
+    value = os.getenv(name)
+    if not value:
+        raise RuntimeError(f"Missing required app setting {name}")
+    return value
+
+
+# Endpoint is normalized to exactly one trailing slash
+AZURE_OPENAI_ENDPOINT = _require_env("AZURE_OPENAI_ENDPOINT").rstrip("/") + "/"
+AZURE_OPENAI_API_KEY = _require_env("AZURE_OPENAI_API_KEY")
+AZURE_OPENAI_DEPLOYMENT = _require_env("AZURE_OPENAI_DEPLOYMENT")
+
+# Turns that fall out of the history window are folded into a running
+# summary by this (ideally cheaper, e.g. gpt-4o-mini) deployment
+AZURE_OPENAI_SUMMARY_DEPLOYMENT = os.getenv(
+    "AZURE_OPENAI_SUMMARY_DEPLOYMENT", AZURE_OPENAI_DEPLOYMENT
+)
+
+# At most the last N user/assistant pairs are sent with each request
+MAX_HISTORY_TURNS = int(os.getenv("MAX_HISTORY_TURNS", "6"))
+
+# The window's oldest turn only moves forward in steps of this many pairs,
+# so consecutive requests share the same prefix (system + oldest kept turns)
+# and keep hitting Azure OpenAI's prompt cache between steps. A step larger
+# than the window itself would cut past every turn, hence the clamp.
+HISTORY_BUFFER_TURNS = min(
+    int(os.getenv("HISTORY_BUFFER_TURNS", "3")), MAX_HISTORY_TURNS
+)
+
+# Shared by every call; any byte change here (even whitespace) invalidates
+# the provider's cached prefix, so keep it a plain literal
+SYSTEM_PROMPT = """
+You are a helpful, friendly, natural-sounding voice assistant.
+Keep responses under 2 sentences unless asked for details.
+Talk like a human — warm, conversational, and helpful.
+"""
+
+# First message of every request; shared, so never mutate it
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+SUMMARY_PROMPT = """
+Summarize this phone call between a caller and a voice assistant in at most
+3 sentences. Keep every fact the assistant may need later: the caller's
+name, what they want, dates, times and anything already agreed.
+"""
+
+# history[0] is the running summary when it starts with this
+SUMMARY_PREFIX = "Summary so far: "
+
+_URL = (
+    f"{AZURE_OPENAI_ENDPOINT}openai/deployments/"
+    f"{AZURE_OPENAI_DEPLOYMENT}/chat/completions"
+    f"?api-version=2024-02-15-preview"
+)
+
+_SUMMARY_URL = (
+    f"{AZURE_OPENAI_ENDPOINT}openai/deployments/"
+    f"{AZURE_OPENAI_SUMMARY_DEPLOYMENT}/chat/completions"
+    f"?api-version=2024-02-15-preview"
+)
+
+_HEADERS = {
+    "Content-Type": "application/json",
+    "api-key": AZURE_OPENAI_API_KEY
+}
+
+# Shared keep-alive pool to Azure OpenAI; created lazily because an
+# aiohttp session must be built inside the running event loop
+_SESSION = None
+
+# Default for every request on the session, so a hung connection can't hold
+# a Functions worker indefinitely; connect is kept short so a dead pooled
+# connection fails over to a fresh one quickly. The voice handlers put their
+# own, shorter deadline on each turn (retries included).
+_TIMEOUT = aiohttp.ClientTimeout(total=15, connect=3, sock_read=10)
+
+# Throttled and server-side failures are retried with full-jitter
+# exponential backoff; a Retry-After longer than the cap means giving up
+_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+_MAX_RETRIES = 2
+_RETRY_BASE_DELAY = 0.5
+_RETRY_MAX_DELAY = 4.0
+
+
+def _get_session() -> aiohttp.ClientSession:
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=50,
+                keepalive_timeout=75,
+                ttl_dns_cache=300,
+            ),
+            timeout=_TIMEOUT,
+        )
+    return _SESSION
+
+
+def _retry_delay(attempt: int, headers):
+    retry_after = headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            delay = None
+        if delay is not None:
+            return delay if delay <= _RETRY_MAX_DELAY else None
+
+    return random.uniform(0, min(_RETRY_MAX_DELAY, _RETRY_BASE_DELAY * 2 ** attempt))
+
+
+@asynccontextmanager
+async def _post(body: bytes, url: str = _URL):
     """
-    Calls Azure OpenAI with conversation history + new user input.
+    POSTs a chat completions request, retrying 429/5xx responses before
+    handing over the (successful) response.
     """
+    session = _get_session()
+    for attempt in range(_MAX_RETRIES + 1):
+        async with session.post(url, headers=_HEADERS, data=body) as response:
+            delay = None
+            if response.status in _RETRY_STATUSES and attempt < _MAX_RETRIES:
+                delay = _retry_delay(attempt, response.headers)
+            if delay is None:
+                response.raise_for_status()
+                yield response
+                return
+        await asyncio.sleep(delay)
 
-    url = (
-        f"{AZURE_OPENAI_ENDPOINT}openai/deployments/"
-        f"{AZURE_OPENAI_DEPLOYMENT}/chat/completions"
-        f"?api-version=2024-02-15-preview"
-    )
 
-    headers = {
-        "Content-Type": "application/json",
-        "api-key": AZURE_OPENAI_API_KEY
-    }
+def is_summary(message: dict) -> bool:
+    return message["role"] == "system" and message["content"].startswith(SUMMARY_PREFIX)
 
-    messages = [{"role": h["role"], "content": h["content"]} for h in history]
-    messages.append({"role": "user", "content": user_text})
+
+def _summary_offset(history: list) -> int:
+    return 1 if history and is_summary(history[0]) else 0
+
+
+def _window_start(turns: list) -> int:
+    overflow = len(turns) - 2 * MAX_HISTORY_TURNS
+    if overflow <= 0:
+        return 0
+
+    # Round the cut up to the next step so it stays put for several turns
+    step = 2 * max(HISTORY_BUFFER_TURNS, 1)
+    return -(-overflow // step) * step
+
+
+def is_unavailable(exc: BaseException) -> bool:
+    """
+    Whether exc means Azure OpenAI timed out or kept throttling / failing
+    through _post's retries, so asking again right away won't help.
+    """
+    if isinstance(exc, asyncio.TimeoutError):
+        return True
+    return isinstance(exc, aiohttp.ClientResponseError) and exc.status in _RETRY_STATUSES
+
+
+def _reply_content(response_json: dict) -> str:
+    # content is null when the reply was filtered (or otherwise cut off
+    # before any text); callers treat that like any other failed request
+    choice = response_json["choices"][0]
+    content = choice["message"].get("content")
+    if not content or choice.get("finish_reason") == "content_filter":
+        raise RuntimeError(
+            f"Azure OpenAI returned no reply (finish_reason={choice.get('finish_reason')})"
+        )
+    return content
+
+
+def _history_window(history: list) -> list:
+    # The summary is sticky; only the turns after it are windowed
+    offset = _summary_offset(history)
+    return history[:offset] + history[offset + _window_start(history[offset:]):]
+
+
+def _request_body(user_text: str, history: list, **options) -> bytes:
+    messages = [
+        _SYSTEM_MSG,
+        *_history_window(history),
+        {"role": "user", "content": user_text}
+    ]
 
     data = {
         "messages": messages,
         "max_tokens": 200,
-        "temperature": 0.7
+        "temperature": 0.7,
+        **options
+    }
+    return orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+
+
+async def ask_llm(user_text: str, history: list):
+    """
+    Calls Azure OpenAI with conversation history + new user input.
+    """
+
+    body = _request_body(user_text, history)
+
+    async with _post(body) as response:
+        response_json = orjson.loads(await response.read())
+
+    return _reply_content(response_json)
+
+
+async def stream_llm(user_text: str, history: list):
+    """
+    Same request as ask_llm, but streamed: yields reply text fragments as
+    Azure OpenAI generates them.
+    """
+
+    body = _request_body(user_text, history, stream=True)
+
+    # Retries only happen before the first chunk, so nothing is yielded twice
+    async with _post(body) as response:
+        # Server-sent events: one "data: {...}" line per chunk
+        async for line in response.content:
+            if not line.startswith(b"data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == b"[DONE]":
+                break
+
+            # The first chunk only carries prompt filter results
+            choices = orjson.loads(payload).get("choices")
+            if not choices:
+                continue
+            delta = choices[0].get("delta", {}).get("content")
+            if delta:
+                yield delta
+
+
+def needs_compaction(history: list) -> bool:
+    offset = _summary_offset(history)
+    return _window_start(history[offset:]) > 0
+
+
+async def compact_history(history: list) -> bool:
+    """
+    Folds the turns the history window no longer sends into the running
+    summary kept at history[0]. Returns whether history changed.
+    """
+    offset = _summary_offset(history)
+    start = _window_start(history[offset:])
+    if not start:
+        return False
+
+    transcript = "\n".join(
+        f"{message['role']}: {message['content']}"
+        for message in history[offset:offset + start]
+    )
+    if offset:
+        previous = history[0]["content"][len(SUMMARY_PREFIX):]
+        transcript = f"Earlier summary: {previous}\n\n{transcript}"
+
+    data = {
+        "messages": [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript}
+        ],
+        "max_tokens": 150,
+        "temperature": 0
     }
 
-    response = requests.post(url, headers=headers, json=data)
-    response.raise_for_status()
+    async with _post(orjson.dumps(data), _SUMMARY_URL) as response:
+        response_json = orjson.loads(await response.read())
+    summary = _reply_content(response_json).strip()
 
-    return response.json()["choices"][0]["message"]["content"]
+    # Only the summarized prefix is replaced; turns appended meanwhile stay
+    history[:offset + start] = [{"role": "system", "content": SUMMARY_PREFIX + summary}]
+    return True
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+import orjson
+from datetime import datetime, timedelta, timezone
+from azure.core.exceptions import ResourceNotFoundError
+from azure.data.tables.aio import TableServiceClient
+from cachetools import TTLCache
+from .llm import MAX_HISTORY_TURNS, HISTORY_BUFFER_TURNS, is_summary
+
+# Optional durable copy of every call's history in Azure Table Storage, so a
+# recycled or scaled-out instance can pick up a call mid-conversation.
+# Without it, history only lives in this process.
+CALL_MEMORY_CONNECTION_STRING = os.getenv("CALL_MEMORY_CONNECTION_STRING")
+CALL_MEMORY_TABLE = os.getenv("CALL_MEMORY_TABLE", "callmemory")
+
+# Rows hold call transcripts, so they are only kept this long after a call's
+# last turn: older rows are ignored on load and deleted by
+# purge_expired_history (run on a timer from function_app)
+CALL_MEMORY_RETENTION = timedelta(
+    minutes=int(os.getenv("CALL_MEMORY_RETENTION_MINUTES", "60"))
+)
+
+# in-memory store per CallSid; a call's history is evicted 30 min after
+# its last turn, and at most 10k calls are kept
+CALL_MEMORY = TTLCache(maxsize=10_000, ttl=1800)
+
+# Everything the request window (including its buffer) can still use;
+# older turns are never sent again, so they aren't persisted either.
+# A running summary at history[0] is always kept.
+_PERSISTED_MESSAGES = 2 * (MAX_HISTORY_TURNS + HISTORY_BUFFER_TURNS)
+
+_ROW_KEY = "history"
+
+# Created on first use, inside the running event loop; the lock keeps
+# concurrent first callers from each building (and leaking) a client
+_TABLE = None
+_TABLE_LOCK = asyncio.Lock()
+
+
+async def _get_table():
+    global _TABLE
+    if _TABLE is None:
+        async with _TABLE_LOCK:
+            if _TABLE is None:
+                service = TableServiceClient.from_connection_string(
+                    CALL_MEMORY_CONNECTION_STRING
+                )
+                _TABLE = await service.create_table_if_not_exists(CALL_MEMORY_TABLE)
+    return _TABLE
+
+
+async def load_history(call_sid: str) -> list:
+    """
+    Returns the call's history, from this process if it has it and from
+    Table Storage otherwise.
+    """
+    history = CALL_MEMORY.get(call_sid)
+    if history is not None or not CALL_MEMORY_CONNECTION_STRING:
+        return history if history is not None else []
+
+    try:
+        table = await _get_table()
+        entity = await table.get_entity(partition_key=call_sid, row_key=_ROW_KEY)
+    except ResourceNotFoundError:
+        # Remembered, so the partial callbacks and the final webhook of a
+        # turn don't each pay for the same 404
+        history = CALL_MEMORY[call_sid] = []
+        return history
+    except Exception:
+        logging.exception("Failed to load call history for %s", call_sid)
+        return []
+
+    # Not purged yet, but past retention all the same
+    if entity.metadata["timestamp"] < datetime.now(timezone.utc) - CALL_MEMORY_RETENTION:
+        history = []
+    else:
+        history = orjson.loads(entity["data"])
+    CALL_MEMORY[call_sid] = history
+    return history
+
+
+def start_history(call_sid: str):
+    # A call that was just answered has nothing stored yet; no need to ask
+    # Table Storage on its first turn
+    if call_sid not in CALL_MEMORY:
+        CALL_MEMORY[call_sid] = []
+
+
+def save_history(call_sid: str, history: list):
+    CALL_MEMORY[call_sid] = history
+
+
+async def persist_history(call_sid: str, history: list):
+    """
+    Writes the call's history to Table Storage, if configured. Meant to run
+    in the background; the in-process copy from save_history is what the
+    next turn on this instance reads.
+    """
+    if not CALL_MEMORY_CONNECTION_STRING:
+        return
+
+    persisted = history[-_PERSISTED_MESSAGES:]
+    if history and is_summary(history[0]) and persisted[0] is not history[0]:
+        persisted = [history[0], *history[1:][-_PERSISTED_MESSAGES:]]
+
+    entity = {
+        "PartitionKey": call_sid,
+        "RowKey": _ROW_KEY,
+        "data": orjson.dumps(persisted),
+    }
+    try:
+        table = await _get_table()
+        await table.upsert_entity(entity)
+    except Exception:
+        # The in-process copy is still current; only a recycle loses it
+        logging.exception("Failed to persist call history for %s", call_sid)
+
+
+async def purge_expired_history() -> int:
+    """
+    Deletes the rows of calls with no turn within CALL_MEMORY_RETENTION and
+    returns how many were deleted.
+    """
+    if not CALL_MEMORY_CONNECTION_STRING:
+        return 0
+
+    table = await _get_table()
+    cutoff = datetime.now(timezone.utc) - CALL_MEMORY_RETENTION
+    expired = table.query_entities(
+        "Timestamp lt @cutoff",
+        parameters={"cutoff": cutoff},
+        select=["PartitionKey", "RowKey"],
+    )
+
+    deleted = 0
+    async for entity in expired:
+        await table.delete_entity(entity["PartitionKey"], entity["RowKey"])
+        deleted += 1
+    return deleted
@@ -1,50 +1,420 @@
+import asyncio
+import logging
+import os
+import re
 import azure.functions as func
-from .llm import ask_llm
+from cachetools import TTLCache
+from functools import lru_cache
+from urllib.parse import urlsplit
+from xml.sax.saxutils import escape
+from .llm import ask_llm, stream_llm, is_unavailable, needs_compaction, compact_history
+from .memory import load_history, save_history, persist_history, start_history
 
-# simple in-memory store per CallSid
-CALL_MEMORY = {}
+# Public scheme://host the voice agent is reached on, set at deploy time.
+# Without it the base is derived from each request's own URL.
+FUNCTION_BASE_URL = os.getenv("FUNCTION_BASE_URL", "").rstrip("/")
 
-def handle_twiml(req: func.HttpRequest) -> func.HttpResponse:
-    base_url = req.url.replace("/api/voiceagents/twiml", "")
+# Request headers are caller-controlled (the routes are anonymous), so the
+# forwarded host/scheme set by Front Door / APIM is only used when this is
+# on and the app is reachable through that proxy alone
+TRUST_FORWARDED_HEADERS = os.getenv("TRUST_FORWARDED_HEADERS", "").lower() == "true"
+
+# Seconds a webhook may spend on the LLM before the caller hears the
+# fallback; Twilio gives up on the request (and the call) at 15s
+_TURN_DEADLINE = 12
+
+# CallSid -> (length of the sentence already spoken, task producing the full
+# reply, the call's history, its assistant message, SHORT_REPLIES key) for
+# replies still streaming when the first sentence was returned. Entries are
+# picked up by handle_continue right after Twilio's <Redirect>; until then
+# history only holds the spoken sentence, which is also all the caller
+# ever hears if the redirect reaches another instance.
+PENDING_REPLIES = TTLCache(maxsize=10_000, ttl=60)
+
+# Replies to short utterances ("hello", "yes") said within the first turn
+# of a call. Keyed on the normalized utterance plus the exact history before
+# it, so "yes" is only reused after the very same question.
+SHORT_REPLIES = TTLCache(maxsize=2048, ttl=300)
+_SHORT_REPLY_MAX_CHARS = 20
+_SHORT_REPLY_MAX_HISTORY = 2
+
+# CallSid -> (normalized stable partial transcript, task asking the LLM
+# about it, loop time the task calls the LLM at, earlier guesses this turn
+# that reached the LLM). Started from Twilio's partial results while the
+# caller is still talking and used by handle_input if the final transcript
+# matches.
+SPECULATIONS = TTLCache(maxsize=10_000, ttl=60)
+
+# A guess only calls the LLM once the stable transcript has held still this
+# long (a superseded guess is cancelled for free before then), and at most
+# this many guesses per turn get that far
+_SPECULATION_DELAY = 0.3
+_MAX_SPECULATIONS = 3
 
-    xml = f"""<?xml version="1.0" encoding="UTF-8"?>
+# CallSids whose history is being summarized right now
+_COMPACTING = set()
+
+# Strong references to fire-and-forget tasks; the event loop only keeps
+# weak ones, so an unreferenced task can be garbage collected mid-run
+_BACKGROUND_TASKS = set()
+
+# End of a sentence with more text already following it
+_SENTENCE_END = re.compile(r"[.!?](?=\s+\S)")
+
+_SPEECH_PUNCTUATION = re.compile(r"[^\w\s']")
+
+_GREETING_TWIML = """<?xml version="1.0" encoding="UTF-8"?>
 <Response>
     <Say voice="Polly.Joanna">Hey, this is your AI assistant. How can I help you today?</Say>
-    <Gather input="speech" action="{base_url}/api/voiceagents/handle-input" method="POST" timeout="5">
+    <Gather input="speech" action="%s" method="POST" timeout="5"
+            speechTimeout="auto" partialResultCallback="%s">
         <Say>If you can, please briefly describe what you need help with.</Say>
     </Gather>
     <Say>I didn’t catch anything, so I’m going to hang up. Feel free to call back.</Say>
     <Hangup/>
 </Response>
-"""
-    return func.HttpResponse(xml, mimetype="application/xml")
+""".encode("utf-8")
+
+_REPLY_TWIML = """<?xml version="1.0" encoding="UTF-8"?>
+<Response>
+    <Say voice="Polly.Joanna">%s</Say>
+    <Gather input="speech" action="%s" method="POST" timeout="5"
+            speechTimeout="auto" partialResultCallback="%s">
+        <Say>What else can I help with?</Say>
+    </Gather>
+</Response>
+""".encode("utf-8")
+
+# First sentence of a reply that is still being generated; Twilio speaks it
+# and then fetches the rest from the continue-reply route
+_PARTIAL_REPLY_TWIML = """<?xml version="1.0" encoding="UTF-8"?>
+<Response>
+    <Say voice="Polly.Joanna">%s</Say>
+    <Redirect method="POST">%s</Redirect>
+</Response>
+""".encode("utf-8")
+
+_FOLLOW_UP_TWIML = """<?xml version="1.0" encoding="UTF-8"?>
+<Response>
+    <Gather input="speech" action="%s" method="POST" timeout="5"
+            speechTimeout="auto" partialResultCallback="%s">
+        <Say>What else can I help with?</Say>
+    </Gather>
+</Response>
+""".encode("utf-8")
+
+# Azure OpenAI is unavailable even after retries; keep the call up and let
+# the caller try again rather than answering Twilio with a 500
+_FALLBACK_TWIML = """<?xml version="1.0" encoding="UTF-8"?>
+<Response>
+    <Say voice="Polly.Joanna">Sorry, I’m having trouble — please hold.</Say>
+    <Pause length="1"/>
+    <Gather input="speech" action="%s" method="POST" timeout="5"
+            speechTimeout="auto" partialResultCallback="%s">
+        <Say>Could you say that again?</Say>
+    </Gather>
+</Response>
+""".encode("utf-8")
+
+# ai_reply is model output and may contain &, < or quotes
+_XML_ENTITIES = {'"': "&quot;"}
+
+
+def _xml_text(text: str) -> bytes:
+    return escape(text, _XML_ENTITIES).encode("utf-8")
+
+
+def _base_url(req: func.HttpRequest) -> str:
+    url = urlsplit(req.url)
+    if not TRUST_FORWARDED_HEADERS:
+        return f"{url.scheme}://{url.netloc}"
+
+    # Front Door / APIM forward the public host; lists are comma separated
+    headers = req.headers
+    host = headers.get("X-Forwarded-Host") or url.netloc
+    proto = headers.get("X-Forwarded-Proto") or url.scheme
+    return f"{proto.split(',')[0].strip()}://{host.split(',')[0].strip()}"
+
+
+@lru_cache(maxsize=None)
+def _configured_route_url(route: str) -> bytes:
+    return _xml_text(f"{FUNCTION_BASE_URL}/api/voiceagents/{route}")
+
+
+def _route_url(req: func.HttpRequest, route: str) -> bytes:
+    # All voice agent routes live side by side under /api/voiceagents/
+    if FUNCTION_BASE_URL:
+        return _configured_route_url(route)
+    return _xml_text(f"{_base_url(req)}/api/voiceagents/{route}")
+
+
+def _gather_urls(req: func.HttpRequest) -> tuple:
+    # action and partialResultCallback of every <Gather>
+    return _route_url(req, "handle-input"), _route_url(req, "partial")
+
+
+def _twiml_response(xml: bytes) -> func.HttpResponse:
+    return func.HttpResponse(
+        xml, mimetype="application/xml", headers={"Cache-Control": "no-store"}
+    )
+
+
+def _log_task_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(
+            "Background task %s failed", task.get_name(), exc_info=task.exception()
+        )
+
+
+def _spawn(coro, name: str = None) -> asyncio.Task:
+    """
+    Starts coro without tying it to the current request; the task is kept
+    alive until it finishes and any exception it raises is logged.
+    """
+    task = asyncio.create_task(coro, name=name)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    task.add_done_callback(_log_task_failure)
+    return task
+
+
+def _normalize_speech(text: str) -> str:
+    # Partial and final transcripts differ in case and punctuation
+    return " ".join(_SPEECH_PUNCTUATION.sub("", text.lower()).split())
+
 
+def _short_reply_key(user_text: str, history: list):
+    if len(user_text) > _SHORT_REPLY_MAX_CHARS or len(history) > _SHORT_REPLY_MAX_HISTORY:
+        return None
+    text = _normalize_speech(user_text)
+    if not text:
+        return None
+    return (text, tuple((message["role"], message["content"]) for message in history))
 
-def handle_input(req: func.HttpRequest) -> func.HttpResponse:
+
+def _remember(
+    call_sid: str, history: list, user_text: str, ai_reply: str, cache: bool = True
+):
+    key = _short_reply_key(user_text, history)
+    if cache and key is not None and ai_reply:
+        SHORT_REPLIES.setdefault(key, ai_reply)
+
+    history.append({"role": "user", "content": user_text})
+    history.append({"role": "assistant", "content": ai_reply})
+    save_history(call_sid, history)
+    _spawn(persist_history(call_sid, history), name=f"persist-{call_sid}")
+
+    if needs_compaction(history) and call_sid not in _COMPACTING:
+        _COMPACTING.add(call_sid)
+        _spawn(_compact(call_sid, history), name=f"compact-{call_sid}")
+
+
+async def _compact(call_sid: str, history: list):
+    # Off the critical path: the reply is already on its way to the caller
+    try:
+        if await compact_history(history):
+            save_history(call_sid, history)
+            await persist_history(call_sid, history)
+    finally:
+        _COMPACTING.discard(call_sid)
+
+
+async def _stream_reply(call_sid, user_text, history, first_sentence):
+    """
+    Streams the reply, resolving first_sentence with its opening sentence
+    as soon as one is complete, and returns the full reply text.
+    """
+    reply = ""
+    async for delta in stream_llm(user_text, history):
+        reply += delta
+        if not first_sentence.done():
+            m = _SENTENCE_END.search(reply)
+            if m:
+                first_sentence.set_result(reply[:m.end()])
+
+    return reply
+
+
+def handle_twiml(req: func.HttpRequest) -> func.HttpResponse:
+    call_sid = req.params.get("CallSid") or req.form.get("CallSid")
+    if call_sid:
+        start_history(call_sid)
+    return _twiml_response(_GREETING_TWIML % _gather_urls(req))
+
+
+async def handle_partial(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Twilio's partialResultCallback: starts answering the caller's stable
+    transcript so far, replacing any earlier guess for the same call.
+    """
+    form = req.form
+    user_text = form.get("StableSpeechResult", "")
+    call_sid = form.get("CallSid", "unknown")
+
+    text = _normalize_speech(user_text)
+    if not text:
+        return func.HttpResponse(status_code=204)
+
+    history = list(await load_history(call_sid))
+
+    # No awaits from here on, so partials for the same call can't interleave
+    # between reading and replacing the call's guess
+    now = asyncio.get_running_loop().time()
+    sent = 0
+    previous = SPECULATIONS.get(call_sid)
+    if previous is not None:
+        previous_text, previous_task, previous_due, sent = previous
+        if now >= previous_due:
+            sent += 1
+        if previous_text == text or sent >= _MAX_SPECULATIONS:
+            return func.HttpResponse(status_code=204)
+        previous_task.cancel()
+
+    # Short openers are answered from SHORT_REPLIES without the LLM
+    if _short_reply_key(user_text, history) in SHORT_REPLIES:
+        SPECULATIONS.pop(call_sid, None)
+        return func.HttpResponse(status_code=204)
+
+    task = _spawn(_speculate(user_text, history), name=f"speculate-{call_sid}")
+    SPECULATIONS[call_sid] = (text, task, now + _SPECULATION_DELAY, sent)
+    return func.HttpResponse(status_code=204)
+
+
+async def _speculate(user_text: str, history: list):
+    await asyncio.sleep(_SPECULATION_DELAY)
+    return await ask_llm(user_text, history)
+
+
+async def _speculated_reply(call_sid: str, user_text: str):
+    # Reply started by handle_partial for exactly this transcript, if any
+    speculation = SPECULATIONS.pop(call_sid, None)
+    if speculation is None:
+        return None
+
+    text, task = speculation[:2]
+    if text != _normalize_speech(user_text):
+        task.cancel()
+        return None
+
+    try:
+        return (await task).strip()
+    except asyncio.CancelledError:
+        # The guess was cancelled by a later partial result; re-raise only
+        # if it is this request being cancelled (turn deadline)
+        if asyncio.current_task().cancelling():
+            raise
+        return None
+    except Exception:
+        logging.warning("Speculative LLM reply failed")
+        return None
+
+
+async def handle_input(req: func.HttpRequest) -> func.HttpResponse:
     form = req.form
     user_text = form.get("SpeechResult", "")
     call_sid = form.get("CallSid", "unknown")
 
+    try:
+        async with asyncio.timeout(_TURN_DEADLINE):
+            return await _answer(req, call_sid, user_text)
+    except TimeoutError:
+        logging.warning("No LLM reply for %s within %ss", call_sid, _TURN_DEADLINE)
+        return _twiml_response(_FALLBACK_TWIML % _gather_urls(req))
+
+
+async def _answer(req: func.HttpRequest, call_sid: str, user_text: str):
     # history
-    history = CALL_MEMORY.get(call_sid, [])
+    history = await load_history(call_sid)
 
-    # get AI reply
-    ai_reply = ask_llm(user_text, history)
+    ai_reply = await _speculated_reply(call_sid, user_text)
+    if ai_reply is None:
+        key = _short_reply_key(user_text, history)
+        ai_reply = SHORT_REPLIES.get(key) if key is not None else None
 
-    # store conversation
-    history.append({"role": "user", "content": user_text})
-    history.append({"role": "assistant", "content": ai_reply})
-    CALL_MEMORY[call_sid] = history
+    if ai_reply is not None:
+        _remember(call_sid, history, user_text, ai_reply)
+        xml = _REPLY_TWIML % (_xml_text(ai_reply), *_gather_urls(req))
+        return _twiml_response(xml)
 
-    # generate base URL again
-    base_url = req.url.replace("/api/voiceagents/handle-input", "")
+    # stream the AI reply and answer as soon as its first sentence is ready
+    first_sentence = asyncio.get_running_loop().create_future()
+    # Spawned rather than awaited: it may outlive this request when only the
+    # first sentence is returned and the caller never reaches continue-reply
+    reply_task = _spawn(
+        _stream_reply(call_sid, user_text, history, first_sentence),
+        name=f"reply-{call_sid}",
+    )
+    try:
+        await asyncio.wait({first_sentence, reply_task}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        # Turn deadline hit; the caller gets the fallback instead
+        reply_task.cancel()
+        raise
 
-    xml = f"""<?xml version="1.0" encoding="UTF-8"?>
-<Response>
-    <Say voice="Polly.Joanna">{ai_reply}</Say>
-    <Gather input="speech" action="{base_url}/api/voiceagents/handle-input" method="POST" timeout="5">
-        <Say>What else can I help with?</Say>
-    </Gather>
-</Response>
-"""
-    return func.HttpResponse(xml, mimetype="application/xml")
+    if not reply_task.done():
+        spoken = first_sentence.result()
+        key = _short_reply_key(user_text, history)
+        _remember(call_sid, history, user_text, spoken.strip(), cache=False)
+        PENDING_REPLIES[call_sid] = (len(spoken), reply_task, history, history[-1], key)
+        xml = _PARTIAL_REPLY_TWIML % (
+            _xml_text(spoken.strip()),
+            _route_url(req, "continue-reply"),
+        )
+        return _twiml_response(xml)
+
+    try:
+        ai_reply = reply_task.result().strip()
+    except Exception as e:
+        # Timed out or still failing after retries: asking again would only
+        # run past Twilio's webhook timeout. The traceback is already logged
+        # by _spawn.
+        if is_unavailable(e):
+            return _twiml_response(_FALLBACK_TWIML % _gather_urls(req))
+
+        # streaming unavailable (or failed before any text): ask in one shot
+        logging.warning("Streaming LLM reply failed; falling back")
+        try:
+            ai_reply = await ask_llm(user_text, history)
+        except Exception:
+            logging.exception("LLM reply failed")
+            return _twiml_response(_FALLBACK_TWIML % _gather_urls(req))
+
+    _remember(call_sid, history, user_text, ai_reply)
+    xml = _REPLY_TWIML % (_xml_text(ai_reply), *_gather_urls(req))
+    return _twiml_response(xml)
+
+
+async def handle_continue(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Speaks the rest of a reply whose first sentence handle_input already
+    returned, then listens for the caller again.
+    """
+    call_sid = req.form.get("CallSid", "unknown")
+    gather_urls = _gather_urls(req)
+
+    # Missing when Twilio's redirect reached a different instance
+    pending = PENDING_REPLIES.pop(call_sid, None)
+    if pending is None:
+        return _twiml_response(_FOLLOW_UP_TWIML % gather_urls)
+
+    spoken_len, reply_task, history, message, key = pending
+    try:
+        async with asyncio.timeout(_TURN_DEADLINE):
+            reply = await reply_task
+    except Exception:
+        logging.warning("Streaming LLM reply failed mid-way")
+        return _twiml_response(_FOLLOW_UP_TWIML % gather_urls)
+
+    # The caller hears the rest now, so history gets the whole reply
+    rest = reply[spoken_len:].strip()
+    message["content"] = reply.strip()
+    save_history(call_sid, history)
+    _spawn(persist_history(call_sid, history), name=f"persist-{call_sid}")
+    if key is not None and message["content"]:
+        SHORT_REPLIES.setdefault(key, message["content"])
+
+    if not rest:
+        return _twiml_response(_FOLLOW_UP_TWIML % gather_urls)
+
+    xml = _REPLY_TWIML % (_xml_text(rest), *gather_urls)
+    return _twiml_response(xml)